@@ -1,7 +1,7 @@
 import os
 import subprocess
 
-def run_bowtie2(forward, reverse, base_name, bowtie2_index, output_dir, threads):
+def run_bowtie2(forward, reverse, base_name, bowtie2_index, output_dir, threads, memory_map=False):
     unmapped_r1 = os.path.join(output_dir, f"{base_name}_unmapped_1.fastq.gz")
     unmapped_r2 = os.path.join(output_dir, f"{base_name}_unmapped_2.fastq.gz") if reverse else None
 
@@ -19,6 +19,10 @@ def run_bowtie2(forward, reverse, base_name, bowtie2_index, output_dir, threads)
         "-S", "/dev/null"
     ]
 
+    # Memory-map the index so concurrent samples share one copy in the page cache
+    if memory_map:
+        bowtie2_cmd.insert(1, "--mm")
+
     print("Running Bowtie2 command:", " ".join(bowtie2_cmd))  # Debug
     subprocess.run(bowtie2_cmd, check=True)
     
@@ -1,7 +1,27 @@
 import os
+import glob
+import shutil
+import tempfile
 import subprocess
 
-def run_kraken2(forward, reverse, base_name, kraken_db, output_dir, threads):
+def stage_kraken_db(kraken_db, ramdisk_dir="/dev/shm"):
+    # Copy the Kraken2 index files (*.k2d) to a RAM-backed directory so every sample reads them from memory
+    db_files = glob.glob(os.path.join(kraken_db, "*.k2d"))
+    if not db_files:
+        raise FileNotFoundError(f"No Kraken2 database files (*.k2d) found in: {kraken_db}")
+
+    staged_db = tempfile.mkdtemp(prefix="kraken_db_", dir=ramdisk_dir)
+    try:
+        for db_file in db_files:
+            shutil.copy(db_file, staged_db)
+    except OSError:
+        shutil.rmtree(staged_db, ignore_errors=True)
+        raise
+
+    print(f"Staged Kraken2 database in {staged_db}")
+    return staged_db
+
+def run_kraken2(forward, reverse, base_name, kraken_db, output_dir, threads, memory_map=False):
     kraken_report = os.path.join(output_dir, f"{base_name}_report.txt")
     kraken_output = os.path.join(output_dir, f"{base_name}_kraken.txt")
 
@@ -12,6 +32,10 @@ def run_kraken2(forward, reverse, base_name, kraken_db, output_dir, threads):
         "--output", kraken_output,
     ]
 
+    # Read the database through mmap so concurrent samples share one copy in the page cache
+    if memory_map:
+        kraken_cmd.append("--memory-mapping")
+
     if reverse:
         kraken_cmd.extend(["--paired", "--gzip-compressed", forward, reverse])
     else:
@@ -1,8 +1,10 @@
 import os
+import io
 import pandas as pd
-import random
-from collections import defaultdict
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 from .trimmomatic import run_trimmomatic
 from .bowtie2 import run_bowtie2
@@ -11,22 +13,56 @@ from .kraken2 import run_kraken2
 # Ensure Kaleido is used for static image export
 pio.kaleido.scope.default_format = "png"
 
-def process_sample(forward, reverse, base_name, bowtie2_index, kraken_db, output_dir, threads, run_bowtie, use_precomputed_reports):
+# Fixed qualitative palette so taxon colors are reproducible between runs
+TAXON_PALETTE = px.colors.qualitative.Dark24
+
+# Layout settings shared by every abundance plot; sizes and titles are set per plot
+ABUNDANCE_LAYOUT = dict(
+    xaxis=dict(tickangle=45),
+    title=dict(x=0.5, font=dict(size=16)),
+    bargap=0.5,
+    legend=dict(
+        x=1,
+        y=1,
+        traceorder='normal',
+        orientation='v',
+        itemwidth=30,
+        itemsizing='constant',
+        itemclick='toggleothers',
+        itemdoubleclick='toggle'
+    )
+)
+
+# 1 MiB I/O buffer for Kraken reports and the merged TSV (default is 8 KiB)
+IO_BUFFER_SIZE = 1 << 20
+
+def has_kraken_report(output_dir, base_name):
+    # A non-empty report means a previous run already classified the sample (kraken2 writes it once classification is done)
+    kraken_report = os.path.join(output_dir, f"{base_name}_report.txt")
+    return os.path.exists(kraken_report) and os.path.getsize(kraken_report) > 0
+
+def process_sample(forward, reverse, base_name, bowtie2_index, kraken_db, output_dir, threads, run_bowtie, use_precomputed_reports, memory_map=False):
+    kraken_report = os.path.join(output_dir, f"{base_name}_report.txt")
+
+    # Skip samples already classified by a previous run
+    if has_kraken_report(output_dir, base_name):
+        print(f"Kraken2 report already exists, skipping {base_name}: {kraken_report}")
+        return kraken_report
+
     if not use_precomputed_reports:
         # Step 1: Run Trimmomatic (only if not using precomputed reports)
         trimmed_forward, trimmed_reverse = run_trimmomatic(forward, reverse, base_name, output_dir, threads)
 
         # Step 2: Optionally Run Bowtie2 to deplete host genome reads
         if run_bowtie:
-            unmapped_r1, unmapped_r2 = run_bowtie2(trimmed_forward, trimmed_reverse, base_name, bowtie2_index, output_dir, threads)
+            unmapped_r1, unmapped_r2 = run_bowtie2(trimmed_forward, trimmed_reverse, base_name, bowtie2_index, output_dir, threads, memory_map)
         else:
             unmapped_r1, unmapped_r2 = trimmed_forward, trimmed_reverse
 
         # Step 3: Use the reads as input for Kraken2
-        kraken_report = run_kraken2(unmapped_r1, unmapped_r2, base_name, kraken_db, output_dir, threads)
+        kraken_report = run_kraken2(unmapped_r1, unmapped_r2, base_name, kraken_db, output_dir, threads, memory_map)
     else:
         # Use the precomputed Kraken2 report
-        kraken_report = os.path.join(output_dir, f"{base_name}_report.txt")
         if not os.path.exists(kraken_report):
             raise FileNotFoundError(f"Precomputed Kraken2 report not found: {kraken_report}")
 
@@ -35,83 +71,124 @@ def process_sample(forward, reverse, base_name, bowtie2_index, kraken_db, output
 def aggregate_kraken_results(kraken_dir, metadata_file, read_count):
     metadata = pd.read_csv(metadata_file, sep=",")
     sample_id_col = metadata.columns[0]  # Assume the first column is the sample ID
+    metadata_cols = metadata.columns[1:].tolist()
+
+    # Index metadata rows by sample ID once (first row wins for duplicated IDs), then release the frame
+    meta_index = metadata.drop_duplicates(sample_id_col).set_index(sample_id_col, drop=False).to_dict(orient="index")
+    del metadata
 
     # Dictionary to store aggregated results
     aggregated_results = {}
 
     # Iterate over each Kraken report file
-    for file_name in os.listdir(kraken_dir):
-        if file_name.endswith("_report.txt"):
-            with open(os.path.join(kraken_dir, file_name), 'r') as f:
+    with os.scandir(kraken_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith("_report.txt"):
+                continue
+
+            # The sample ID and its metadata are the same for every line of a report
+            extracted_part = '_'.join(entry.name.split('_')[:-1])
+            sample_metadata = meta_index.get(extracted_part)
+            if sample_metadata is None:
+                continue
+
+            with open(entry.path, 'r', buffering=IO_BUFFER_SIZE) as f:
                 for line in f:
                     fields = line.strip().split('\t')
-                    perc_frag_cover = fields[0]
-                    nr_frag_cover = fields[1]
-                    nr_frag_direct_at_taxon = int(fields[2])
                     rank_code = fields[3]
+                    if rank_code != 'S':
+                        continue
+                    nr_frag_direct_at_taxon = int(fields[2])
+                    if nr_frag_direct_at_taxon < read_count:
+                        continue
+
                     ncbi_ID = fields[4]
-                    scientific_name = fields[5]
-                    parts = file_name.split('_')
-                    extracted_part = '_'.join(parts[:-1])
-                    sampleandtaxonid = extracted_part + str(ncbi_ID)
-
-                    if rank_code == 'S' and nr_frag_direct_at_taxon >= read_count:
-                        if extracted_part in metadata[sample_id_col].unique():
-                            sample_metadata = metadata.loc[metadata[sample_id_col] == extracted_part].iloc[0].to_dict()
-                            aggregated_results[sampleandtaxonid] = {
-                                'Perc_frag_cover': perc_frag_cover,
-                                'Nr_frag_cover': nr_frag_cover,
-                                'Nr_frag_direct_at_taxon': nr_frag_direct_at_taxon,
-                                'Rank_code': rank_code,
-                                'NCBI_ID': ncbi_ID,
-                                'Scientific_name': scientific_name,
-                                'SampleID': extracted_part,
-                                **sample_metadata
-                            }
+                    aggregated_results[extracted_part + ncbi_ID] = {
+                        'Perc_frag_cover': fields[0],
+                        'Nr_frag_cover': fields[1],
+                        'Nr_frag_direct_at_taxon': nr_frag_direct_at_taxon,
+                        'Rank_code': rank_code,
+                        'NCBI_ID': ncbi_ID,
+                        'Scientific_name': fields[5],
+                        'SampleID': extracted_part,
+                        **sample_metadata
+                    }
 
     # Output aggregated results to a TSV file
     merged_tsv_path = os.path.join(kraken_dir, "merged_kraken1.tsv")
-    with open(merged_tsv_path, 'w') as f:
-        # Write headers dynamically
-        headers = ['Perc_frag_cover', 'Nr_frag_cover', 'Nr_frag_direct_at_taxon', 'Rank_code', 'NCBI_ID', 'Scientific_name', 'SampleID'] + metadata.columns[1:].tolist()
-        f.write("\t".join(headers) + "\n")
-        for sampleandtaxonid, data in aggregated_results.items():
-            f.write("\t".join(str(data[col]) for col in headers) + "\n")
-
-    return merged_tsv_path
-
-def generate_abundance_plots(merged_tsv_path, top_N):
-    df = pd.read_csv(merged_tsv_path, sep="\t")
+    headers = ['Perc_frag_cover', 'Nr_frag_cover', 'Nr_frag_direct_at_taxon', 'Rank_code', 'NCBI_ID', 'Scientific_name', 'SampleID'] + metadata_cols
+    merged_df = pd.DataFrame.from_dict(aggregated_results, orient="index").reindex(columns=headers)
+    with open(merged_tsv_path, 'w', buffering=IO_BUFFER_SIZE) as f:
+        merged_df.to_csv(f, sep="\t", index=False)
+
+    # Also return the table itself so callers don't have to parse the TSV again
+    return merged_tsv_path, _as_read_from_tsv(merged_df, metadata_cols)
+
+def _as_read_from_tsv(merged_df, metadata_cols):
+    # Give the merged table the dtypes pd.read_csv would infer from the TSV, without re-parsing the whole file
+    if merged_df.empty:
+        return merged_df.astype(object)  # A header-only TSV reads back as object columns
+    merged_df = merged_df.astype({'Perc_frag_cover': float, 'Nr_frag_cover': int, 'NCBI_ID': int}).reset_index(drop=True)
+
+    # Metadata values only repeat per sample, so parsing one row per sample yields the same inferred dtypes
+    sample_cols = ['SampleID'] + metadata_cols
+    sample_rows = merged_df[sample_cols].drop_duplicates('SampleID')
+    typed_rows = pd.read_csv(io.StringIO(sample_rows.to_csv(sep="\t", index=False)), sep="\t")
+    typed_rows.index = sample_rows['SampleID']
+    merged_df[sample_cols] = typed_rows.reindex(merged_df['SampleID']).reset_index(drop=True)
+    return merged_df
+
+def _render_figure(item):
+    # Rebuild the figure from its picklable dict (PNGs are exported in a worker process) and export it
+    fig_dict, output_path, html, plot_scale = item
+    fig = go.Figure(fig_dict)
+    if html:
+        # Load plotly.js from the CDN instead of embedding the ~4.5 MB library in every file
+        fig.write_html(output_path, include_plotlyjs="cdn")
+    else:
+        fig.write_image(output_path, format='png', scale=plot_scale)
+    return output_path
+
+def _available_cpus():
+    # CPUs this process may run on (honours taskset and batch-scheduler CPU sets), else the machine total
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def generate_abundance_plots(merged_tsv_path, top_N, html=False, plot_scale=1, merged_df=None, threads=None):
+    # Use the table returned by aggregate_kraken_results when given, instead of parsing the TSV again
+    df = merged_df.copy() if merged_df is not None else pd.read_csv(merged_tsv_path, sep="\t")
     df.columns = df.columns.str.replace('/', '_').str.replace(' ', '_')
-    df = df.apply(lambda col: col.map(lambda x: x.strip() if isinstance(x, str) else x))
+    # Object columns can also hold non-strings (e.g. True/NaN flags), so only strip the pure string ones
+    str_cols = [col for col in df.select_dtypes(include="object").columns if pd.api.types.infer_dtype(df[col], skipna=True) == "string"]
+    df[str_cols] = df[str_cols].apply(lambda s: s.str.strip())
     df = df[df['Scientific_name'] != 'Homo sapiens']
+    figures = []
+
+    # Classify taxa once with a literal, case-insensitive match; bacterial plots use the complement
+    is_virus = df['Scientific_name'].str.lower().str.contains('virus', regex=False, na=False)
+
+    # Text columns to plot against; each focus keeps only these plus the taxon name and read count
+    categorical_cols = [col for col in df.select_dtypes(include=['object']).columns if col not in ('Scientific_name', 'Nr_frag_direct_at_taxon')]
+    plot_cols = ['Scientific_name', 'Nr_frag_direct_at_taxon'] + categorical_cols
 
     # Generate both viral and bacterial abundance plots
-    for focus, filter_str, plot_title in [
-        ('Virus_Type', 'Virus', 'Viral'),
-        ('Bacteria_Type', 'Virus', 'Bacterial')
+    for focus, focus_mask, plot_title in [
+        ('Virus_Type', is_virus, 'Viral'),
+        ('Bacteria_Type', ~is_virus, 'Bacterial')
     ]:
-        if focus == 'Bacteria_Type':
-            df_focus = df[~df['Scientific_name'].str.contains(filter_str, case=False, na=False)]
-        else:
-            df_focus = df[df['Scientific_name'].str.contains(filter_str, case=False, na=False)]
-        df_focus = df_focus.rename(columns={'Scientific_name': focus})
+        df_focus = df.loc[focus_mask, plot_cols].rename(columns={'Scientific_name': focus})
 
         if top_N:
             top_N_categories = df_focus[focus].value_counts().head(top_N).index
             df_focus = df_focus[df_focus[focus].isin(top_N_categories)]
 
-        categorical_cols = df_focus.select_dtypes(include=['object']).columns.tolist()
-        categorical_cols.remove(focus)
+        # One color per taxon, shared by every plot of this focus
+        colordict = dict(zip(df_focus[focus].unique(), itertools.cycle(TAXON_PALETTE)))
 
         for col in categorical_cols:
             grouped_sum = df_focus.groupby([focus, col])['Nr_frag_direct_at_taxon'].mean().reset_index()
 
-            colordict = defaultdict(int)
-            random_colors = ["#{:06x}".format(random.randint(0, 0xFFFFFF)) for _ in range(len(grouped_sum[col].unique()))]
-            for target, color in zip(grouped_sum[focus].unique(), random_colors):
-                colordict[target] = color
-
             plot_width = 1100 + 5 * len(grouped_sum[col].unique())
             plot_height = 800 + 5 * len(grouped_sum[col].unique())
             font_size = max(10, 14 - len(grouped_sum[col].unique()) // 10)
@@ -126,26 +203,28 @@ def generate_abundance_plots(merged_tsv_path, top_N):
             )
 
             fig.update_layout(
-                xaxis=dict(tickfont=dict(size=font_size), tickangle=45),
-                yaxis=dict(tickfont=dict(size=font_size)),
-                title=dict(text=f'Average {plot_title} Abundance by {col}', x=0.5, font=dict(size=16)),
-                bargap=0.5,
-                legend=dict(
-                    font=dict(size=font_size),
-                    x=1,
-                    y=1,
-                    traceorder='normal',
-                    orientation='v',
-                    itemwidth=30,
-                    itemsizing='constant',
-                    itemclick='toggleothers',
-                    itemdoubleclick='toggle'
-                ),
+                ABUNDANCE_LAYOUT,
+                xaxis_tickfont_size=font_size,
+                yaxis_tickfont_size=font_size,
+                legend_font_size=font_size,
+                title_text=f'Average {plot_title} Abundance by {col}',
                 width=plot_width,
                 height=plot_height
             )
 
-            output_path = f"{plot_title}_Abundance_by_{col}.png"
-            fig.write_image(output_path, format='png', scale=3)
-
-            print(f"Figure saved as {output_path}")
+            output_path = f"{plot_title}_Abundance_by_{col}.{'html' if html else 'png'}"
+            figures.append((fig.to_dict(), output_path, html, plot_scale))
+
+    if html:
+        # HTML export is only serialisation, so worker start-up would cost more than it saves
+        for item in figures:
+            print(f"Figure saved as {_render_figure(item)}")
+    elif figures:
+        # Export PNGs in parallel, within the thread budget and the CPUs this process may use;
+        # each worker process reuses its own Kaleido scope
+        max_workers = min(len(figures), _available_cpus())
+        if threads:
+            max_workers = min(max_workers, threads)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for output_path in executor.map(_render_figure, figures):
+                print(f"Figure saved as {output_path}")
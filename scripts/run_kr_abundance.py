@@ -1,9 +1,39 @@
 import sys
 import os
+import re
 import argparse
-import glob
-import pandas as pd
-from Metagenomics_pipeline.kraken_abundance_pipeline import process_sample, aggregate_kraken_results, generate_abundance_plots
+import pathlib
+import atexit
+import shutil
+import signal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Metagenomics_pipeline.kraken_abundance_pipeline import process_sample, has_kraken_report, aggregate_kraken_results, generate_abundance_plots
+from Metagenomics_pipeline.kraken2 import stage_kraken_db
+
+# Forward read files end in _R1.fastq or _R1.fastq.gz; the captured extension is reused for the mate
+_R1_RE = re.compile(r"_R1(\.fastq(?:\.gz)?)$")
+
+def _parse_forward(forward):
+    forward_path = pathlib.Path(forward)
+    match = _R1_RE.search(forward_path.name)
+    base_name = forward_path.name[:match.start()]
+    reverse_path = forward_path.with_name(f"{base_name}_R2{match.group(1)}")
+    reverse = str(reverse_path) if reverse_path.is_file() else None
+    return base_name, reverse
+
+def _run_one(forward, args, threads, run_bowtie, memory_map):
+    base_name, reverse = _parse_forward(forward)
+
+    # Process each sample and run Trimmomatic, Bowtie2, Kraken2
+    return process_sample(forward, reverse, base_name, args.bowtie2_index, args.kraken_db, args.output_dir, threads, run_bowtie, args.use_precomputed_reports, memory_map)
+
+def _exit_on_sigterm(signum, frame):
+    # Batch schedulers (SLURM, PBS) stop jobs with SIGTERM; exiting normally lets atexit remove the staged database
+    sys.exit(128 + signum)
+
+def _default_sigterm():
+    # Sample workers keep the default SIGTERM action, so a stopped job does not go on to their next queued sample
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 def main():
     parser = argparse.ArgumentParser(description="Pipeline for Trimmomatic trimming, Bowtie2 host depletion (optional), and Kraken2 taxonomic classification.")
@@ -12,42 +42,64 @@ def main():
     parser.add_argument("--output_dir", required=True, help="Directory to save output files.")
     parser.add_argument("--input_dir", required=True, help="Directory containing input FASTQ files.")
     parser.add_argument("--threads", type=int, default=8, help="Number of threads to use for Trimmomatic, Bowtie2, and Kraken2.")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of samples to process in parallel (threads are split between them).")
     parser.add_argument("--metadata_file", required=True, help="Path to the metadata CSV file.")
     parser.add_argument("--read_count", type=int, default=0, help="Minimum read count threshold.")
     parser.add_argument("--top_N", type=int, default=None, help="Select the top N most common viruses or bacteria.")
     parser.add_argument("--no_bowtie2", action='store_true', help="Skip Bowtie2 host depletion.")
     parser.add_argument("--bacteria", action='store_true', help="Generate bacterial abundance plots.")
     parser.add_argument("--virus", action='store_true', help="Generate viral abundance plots.")
+    parser.add_argument("--html", action='store_true', help="Save plots as interactive HTML instead of PNG.")
+    parser.add_argument("--plot_scale", type=float, default=1, help="Resolution multiplier for PNG plots (e.g. 3 for print quality).")
     parser.add_argument("--use_precomputed_reports", action='store_true', help="Use precomputed Kraken reports instead of running Kraken2.")
+    parser.add_argument("--kraken_db_ramdisk", action='store_true', help="Copy the Kraken2 database to /dev/shm once and use it for all samples.")
 
     args = parser.parse_args()
     os.makedirs(args.output_dir, exist_ok=True)
 
     run_bowtie = not args.no_bowtie2 and args.bowtie2_index is not None
 
-    # Step 1: Process each sample
-    for forward in glob.glob(os.path.join(args.input_dir, "*_R1.fastq*")):
-        base_name = os.path.basename(forward).replace("_R1.fastq.gz", "").replace("_R1.fastq", "")
-        reverse = os.path.join(args.input_dir, f"{base_name}_R2.fastq.gz") if forward.endswith(".gz") else os.path.join(args.input_dir, f"{base_name}_R2.fastq")
-        
-        if not os.path.isfile(reverse):
-            reverse = None
+    with os.scandir(args.input_dir) as entries:
+        # Skip hidden files (e.g. macOS ._*_R1.fastq.gz AppleDouble files) and directories, as glob did
+        forward_files = [entry.path for entry in entries if not entry.name.startswith(".") and entry.is_file() and _R1_RE.search(entry.name)]
+
+    # Load the Kraken2 database into RAM once instead of re-reading it from disk for every sample,
+    # but only if some sample still needs Kraken2 (finished samples are skipped)
+    if args.kraken_db_ramdisk and not args.use_precomputed_reports:
+        if any(not has_kraken_report(args.output_dir, _parse_forward(forward)[0]) for forward in forward_files):
+            args.kraken_db = stage_kraken_db(args.kraken_db)
+            atexit.register(shutil.rmtree, args.kraken_db, ignore_errors=True)
+            signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        else:
+            print("All samples already have Kraken2 reports; not staging the Kraken2 database.")
 
-        # Process each sample and run Trimmomatic, Bowtie2, Kraken2
-        process_sample(forward, reverse, base_name, args.bowtie2_index, args.kraken_db, args.output_dir, args.threads, run_bowtie, args.use_precomputed_reports)
+    # Step 1: Process each sample, splitting the thread budget across parallel jobs
+    jobs = max(1, args.jobs)
+    threads_per_job = max(1, args.threads // jobs)
+    # Parallel samples (or a RAM-staged database) share the Kraken2/Bowtie2 indexes through mmap instead of each loading a copy
+    memory_map = jobs > 1 or args.kraken_db_ramdisk
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_default_sigterm) as executor:
+        futures = [executor.submit(_run_one, forward, args, threads_per_job, run_bowtie, memory_map) for forward in forward_files]
+        try:
+            for future in as_completed(futures):
+                future.result()  # Re-raise any error from the sample's worker
+        except BaseException:
+            # Don't start queued samples once the run is failing or being stopped (e.g. SIGTERM)
+            for future in futures:
+                future.cancel()
+            raise
 
     # Step 2: Aggregate Kraken results
-    merged_tsv_path = aggregate_kraken_results(args.output_dir, args.metadata_file, args.read_count)
+    merged_tsv_path, merged_df = aggregate_kraken_results(args.output_dir, args.metadata_file, args.read_count)
     print(f"Aggregated Kraken results saved to: {merged_tsv_path}")
 
     # Step 3: Generate both viral and bacterial abundance plots
-    df = pd.read_csv(merged_tsv_path, sep="\t")
     print("Preview of aggregated Kraken results:")
-    print(df.head())  # Preview the data before plotting
+    print(merged_df.head())  # Preview the data before plotting
 
     # Step 4: Generate plots based on user input
     if args.bacteria or args.virus:
-        generate_abundance_plots(merged_tsv_path, args.top_N)
+        generate_abundance_plots(merged_tsv_path, args.top_N, args.html, args.plot_scale, merged_df=merged_df, threads=args.threads)
     else:
         print("No --bacteria or --virus flag provided. No plots will be generated.")
 